@@ -1,10 +1,20 @@
-import json
+import os
 import random
-import uuid
+import re
 import logging
-from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Generator
-from train_and_score import score_customer
+import math
+import multiprocessing
+import queue
+import traceback
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from itertools import groupby
+from typing import Dict, List, Generator, Optional, Set, Tuple
+import orjson
+from train_and_score import score_customers
 
 # Configure logging to file and console
 logging.basicConfig(
@@ -17,10 +27,59 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 WINDOW_30D = timedelta(days=30)
+SECONDS_PER_DAY = 86400
+EPOCH_DATE = date(1970, 1, 1)
+MAX_WORKERS = 8
+
+#CPUs this process may run on, honouring the CPU affinity (e.g. docker --cpuset-cpus) where the OS exposes it
+def _available_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+N_WORKERS = min(_available_cpus(), MAX_WORKERS)
+
+_REQUIRED_FIELDS = frozenset(("event_id", "customer_id", "event_time", "event_type", "amount"))
+
+# customer_id format: "C" followed by 3 digits
+_CID_MATCH = re.compile(r"C[0-9]{3}").fullmatch
+
+#Valid event times, in epoch seconds: from the epoch up to year 3000. This also rejects epochs in milliseconds.
+MIN_EVENT_TS = 0
+MAX_EVENT_TS = int(datetime(3000, 1, 1, tzinfo=timezone.utc).timestamp())
+
+#Normalizes the event_time only once to epoch seconds and caches it with its day number (days since the epoch)
+#on the event itself, so the window function, the consumer and the state store only do integer math on it.
+#ISO strings (the wire format of the message schema) are parsed here, at the ingress boundary.
+def _parse_event(event: Dict) -> int:
+    if "_ts" not in event:
+        event_time = event["event_time"]
+        if isinstance(event_time, str):
+            event_time = datetime.fromisoformat(event_time.replace("Z", "+00:00")).timestamp()
+        elif isinstance(event_time, bool) or not isinstance(event_time, (int, float)):
+            raise TypeError(f"event_time must be epoch seconds or an ISO 8601 string, got {type(event_time).__name__}")
+        if not MIN_EVENT_TS <= event_time < MAX_EVENT_TS:  # also false for inf and nan
+            raise ValueError(f"event_time out of range (epoch seconds expected): {event_time}")
+        ts = int(event_time)
+        event["_ts"] = ts
+        event["_day"] = ts // SECONDS_PER_DAY
+    return event["_ts"]
+
+#Features of the fixed 30 days shape, built from the running aggregates of a customer (total_amount in cents).
+#The average is rounded to the cent half up, exactly, with integer math: floor(total / txn + 1/2).
+def _build_features(total_txn: int, total_amount: int) -> Dict:
+    if not total_txn:
+        return {"total_txn_30d": 0, "total_amount_30d": 0.0, "avg_amount_30d": 0.0}
+    return {
+        "total_txn_30d": total_txn,
+        "total_amount_30d": total_amount / 100,
+        "avg_amount_30d": (2 * total_amount + total_txn) // (2 * total_txn) / 100,
+    }
 
 #This function is the simulated producer.
 #Simulates a Kafka topic emitting transaction events. 
-#Includes duplicates and out-of-order delivery generation.
+#Includes duplicates and out-of-order delivery generation: events are emitted in event_time order,
+#and with probability out_of_order_rate an event is delivered after the next one (neighbour swap).
 def simulated_kafka_stream(
     num_customers: int = 5,
     events_per_customer: int = 10,
@@ -42,9 +101,9 @@ def simulated_kafka_stream(
             event_time = base_time - timedelta(days=random.randint(0, 40))
 
             event = {
-                "event_id": str(uuid.uuid4()),
+                "event_id": random.getrandbits(64),
                 "customer_id": customer_id,
-                "event_time": event_time.isoformat(),
+                "event_time": int(event_time.timestamp()),  # epoch seconds
                 "event_type": "transaction",
                 "amount": round(random.uniform(10, 300), 2),
             }
@@ -55,13 +114,34 @@ def simulated_kafka_stream(
             if random.random() < duplicate_rate:
                 events.append(event.copy())
 
-    # shuffle to simulate out-of-order events
-    if random.random() < out_of_order_rate:
-        random.shuffle(events)
+    events.sort(key=lambda event: event["event_time"])
 
+    # swap neighbours to simulate out-of-order events, instead of shuffling the whole topic
+    late_event = None
     for event in events:
+        if late_event is None and random.random() < out_of_order_rate:
+            late_event = event  # delivered right after the next event
+            continue
+
         yield event
 
+        if late_event is not None:
+            yield late_event
+            late_event = None
+
+    if late_event is not None:
+        yield late_event
+
+#Item of the customer balances table. Slots make attribute access cheaper than string keys in a dict.
+@dataclass(slots=True)
+class CustomerState:
+    daily_sums: OrderedDict = field(default_factory=OrderedDict)  # {days since epoch: {"amount": int, "count": int}}, oldest day first
+    features: Optional[Dict] = None
+    # running aggregates over daily_sums, kept in sync on update and eviction.
+    # Amounts are integer cents, so adding and evicting days leaves no float drift.
+    total_txn: int = 0
+    total_amount: int = 0
+
 #This class simulates a DynamoDB-like state store.
 #Replace the in-memory structures with actual DynamoDB calls in production using the boto3 library.
 #Set up DynamoDB table with partition key as customer_id (?)
@@ -69,194 +149,306 @@ class StateStore:
 
     def __init__(self):
         # = boto3.client('dynamodb')
-        self.balances: Dict[str, Dict] = {} # to track customer balances
-        self.seen_event_ids = set() # to track duplicates easily
+        self.balances: Dict[str, CustomerState] = {} # to track customer balances
+        self.customer_ids: List[str] = [] # keys of balances in a list, to sample customers without copying the table
+        self.seen_event_ids: Set[int] = set() # to track duplicates easily, 64-bit ids are cheaper to store and hash than uuid strings
 
     # Works on the idempotency table
-    def is_duplicate(self, event_id: str) -> bool:
+    def is_duplicate(self, event_id: int) -> bool:
         return event_id in self.seen_event_ids
 
     # Works on the idempotency table
-    def mark_seen(self, event_id: str):
+    def mark_seen(self, event_id: int):
         self.seen_event_ids.add(event_id)
 
     # Works on the customer balances table
-    def get_customer(self, customer_id: str) -> Dict:
+    def get_customer(self, customer_id: str) -> CustomerState:
         if customer_id not in self.balances:
-            self.balances[customer_id] = {
-                "daily_sums": {}  # {date: {"amount": float, "count": int}}
-            }
+            self.balances[customer_id] = CustomerState()
+            self.customer_ids.append(customer_id)
         return self.balances[customer_id]
     
-    def update_daily_sum(self, customer_id: str, event: Dict):
+    def update_daily_sum(self, customer_id: str, day: int, amount: float):
         customer = self.get_customer(customer_id)
         
-        event_time = datetime.fromisoformat(event["event_time"])
-        date_key = event_time.date().isoformat()  # "2026-01-28"
+        daily_sums = customer.daily_sums
+        date_key = day  # epoch seconds // 86400, cached on the event by _parse_event
         
         # If date exists, add to it; otherwise create new entry
-        if date_key not in customer["daily_sums"]:
-            customer["daily_sums"][date_key] = {"amount": 0.0, "count": 0}
-
-        customer["daily_sums"][date_key]["amount"] += event["amount"]
-        customer["daily_sums"][date_key]["count"] += 1
+        if date_key not in daily_sums:
+            newer_days = []
+            if daily_sums and next(reversed(daily_sums)) > date_key:
+                # A late event opened an older day: move the newer days after it to keep the buckets sorted
+                newer_days = [d for d in daily_sums if d > date_key]
+            daily_sums[date_key] = {"amount": 0, "count": 0}
+            for d in newer_days:
+                daily_sums.move_to_end(d)
+
+        amount = round(amount * 100)  # in cents
+        daily_sum = daily_sums[date_key]
+        daily_sum["amount"] += amount
+        daily_sum["count"] += 1
+        customer.total_txn += 1
+        customer.total_amount += amount
 
     def update_customer_features(self, customer_id: str, features: Dict):
         customer = self.get_customer(customer_id)
-        customer["features"] = features
+        customer.features = features
     
-    def evict_old_events(self, customer_id: str, cutoff: datetime):
+    def evict_old_events(self, customer_id: str, cutoff_day: int):
+        # Buckets are sorted by day, so only the oldest ones need to be checked
         customer = self.get_customer(customer_id)
-        keys_to_delete = [
-            date_key for date_key in customer["daily_sums"]
-            if datetime.fromisoformat(date_key).date() < cutoff.date()
-        ]
-        for key in keys_to_delete:
-            del customer["daily_sums"][key]
+        daily_sums = customer.daily_sums
+        while daily_sums and next(iter(daily_sums)) < cutoff_day:
+            _, evicted = daily_sums.popitem(last=False)
+            customer.total_txn -= evicted["count"]
+            customer.total_amount -= evicted["amount"]
     
-    def get_five_random_customers(self) -> List[str]:
-        return random.sample(list(self.balances.items()), 5)
+    # Merges the balances built by another store, partitions are disjoint by customer_id so it is a plain union
+    def merge(self, balances: Dict[str, CustomerState]):
+        self.customer_ids.extend(customer_id for customer_id in balances if customer_id not in self.balances)
+        self.balances.update(balances)
+
+    def get_five_random_customers(self) -> List[Tuple[str, CustomerState]]:
+        return [(customer_id, self.balances[customer_id]) for customer_id in random.sample(self.customer_ids, 5)]
     
     def save_on_file(self):
-        with open("src/data/balances.json", "w") as f:
-            json.dump(self.balances, f)
+        # daily_sums are keyed by day numbers and amounts are in cents in memory,
+        # the file keeps the readable dates and amounts
+        balances = {
+            customer_id: {
+                "daily_sums": {
+                    (EPOCH_DATE + timedelta(days=d)).isoformat(): {"amount": s["amount"] / 100, "count": s["count"]}
+                    for d, s in customer.daily_sums.items()
+                },
+                "total_txn": customer.total_txn,
+                "total_amount": customer.total_amount / 100,
+                "features": customer.features,
+            }
+            for customer_id, customer in self.balances.items()
+        }
+        with open("src/data/balances.json", "wb") as f:
+            f.write(orjson.dumps(balances))
+
+    # Saves on a background thread so the caller can go on (e.g. scoring) while the file is written.
+    # The state must not change until the returned future is done, its result() re-raises a failed save.
+    def save_on_file_async(self) -> Future:
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="save-balances")
+        future = executor.submit(self.save_on_file)
+        executor.shutdown(wait=False)  # the submitted save still runs to completion
+        return future
 
 #consumer class that processes events and computes features
 class FeatureBuilder:
     def __init__(self, state_store: StateStore):
         self.state_store = state_store
-        self.max_event_time = None
+        self.max_event_time = float("-inf")  # epoch seconds of the latest event seen
     
-    def _evict_old_events(self, customer_id, reference_time: datetime):
-        cutoff = reference_time - WINDOW_30D
-        self.state_store.evict_old_events(customer_id,cutoff)
+    def _evict_old_events(self, customer_id, reference_time: int):
+        cutoff_day = reference_time // SECONDS_PER_DAY - WINDOW_30D.days
+        self.state_store.evict_old_events(customer_id, cutoff_day)
 
     def _compute_features(self, customer_id) -> Dict:
         customer = self.state_store.get_customer(customer_id)
-        events = customer["daily_sums"]
-
-        #print(f"  Daily sums: {list(events.keys())}")
-        #print(f"  Counts: {[(k, v['count']) for k, v in events.items()]}")
-    
-
-        if not events:
-            features = {
-                "total_txn_30d": 0,
-                "total_amount_30d": 0.0,
-                "avg_amount_30d": 0.0,
-            }
-            self.state_store.update_customer_features(customer_id, features)
-            return features
-
-        total_txn = sum(event["count"] for event in events.values())
-        total_amount = sum(event["amount"] for event in events.values())
-
-        features = {
-            "total_txn_30d": total_txn,
-            "total_amount_30d": round(total_amount, 2),
-            "avg_amount_30d": round(total_amount / total_txn, 2),
-        }
+        features = _build_features(customer.total_txn, customer.total_amount)
         self.state_store.update_customer_features(customer_id, features)
         return features
 
     def process_event(self, event: Dict):
-        # basic validation
-        required_fields = {"event_id", "customer_id", "event_time", "event_type", "amount"}
-        if not required_fields.issubset(event):
-            missing = required_fields - set(event.keys())
-            logger.warning(f"Skipping event - missing fields: {missing}. Event: {event}")
+        accepted = self.accept_event(event)
+        if accepted is None:
             return
+        customer_id, day, amount = accepted
+        return self.apply_event(customer_id, day, amount, self.max_event_time)
 
-        # Validate customer_id format: "C" followed by 3 digits
-        customer_id = event["customer_id"]
-        if not isinstance(customer_id, str) or len(customer_id) != 4 or customer_id[0] != "C" or not customer_id[1:].isdigit():
-            logger.warning(f"Skipping event - invalid customer_id format: {customer_id}. Expected format: C###")
-            return
+    # First half of process_event: deduplicates and validates the event, marks it as seen and advances
+    # the latest event time seen. Returns (customer_id, day, amount), or None when the event is skipped.
+    def accept_event(self, event: Dict) -> Optional[Tuple[str, int, float]]:
+        state_store = self.state_store
 
-        # Check if event is duplicate
-        event_id = event["event_id"]
-        if self.state_store.is_duplicate(event_id):
-            logger.warning(f"Skipping duplicate event: {event_id}")
+        # Check if event is duplicate first, it is the cheapest check and duplicates skip all the work below
+        if state_store.is_duplicate(event.get("event_id")):
+            logger.warning("Skipping duplicate event: %s", event.get("event_id"))
             return
 
-        self.state_store.mark_seen(event_id)
+        # basic validation
+        if not _REQUIRED_FIELDS.issubset(event):
+            missing = sorted(_REQUIRED_FIELDS.difference(event))
+            logger.warning("Skipping event - missing fields: %s. Event: %s", missing, event)
+            return
 
+        event_id = event["event_id"]
         customer_id = event["customer_id"]
+        raw_event_time = event["event_time"]
+        raw_amount = event["amount"]
+
+        # Validate customer_id format: "C" followed by 3 digits
+        if not (isinstance(customer_id, str) and _CID_MATCH(customer_id)):
+            logger.warning("Skipping event - invalid customer_id format: %s. Expected format: C###", customer_id)
+            return
+
         # Check if event_time is valid
         try:
-            event_time = datetime.fromisoformat(event["event_time"].replace("Z", "+00:00"))
-        except (ValueError, AttributeError) as e:
-            logger.error(f"Skipping event {event_id} - invalid event_time: {event['event_time']}. Error: {e}")
+            event_time = _parse_event(event)
+        except (ValueError, TypeError, OverflowError) as e:
+            logger.error("Skipping event %s - invalid event_time: %s. Error: %s", event_id, raw_event_time, e)
             return
 
         # Check if amount is numeric
         try:
-            amount = float(event["amount"])
+            amount = float(raw_amount)
             if amount < 0:
-                logger.error(f"Skipping event {event_id} - negative amount: {amount}")
+                logger.error("Skipping event %s - negative amount: %s", event_id, amount)
+                return
+            # Amounts are summed as integer cents, so they can't have more than 2 decimals
+            if not math.isfinite(amount) or abs(amount * 100 - round(amount * 100)) > 1e-6:
+                logger.error("Skipping event %s - amount must be finite with at most 2 decimals: %s", event_id, amount)
                 return
         except (ValueError, TypeError) as e:
-            logger.error(f"Skipping event {event_id} - invalid amount: {event['amount']}. Error: {e}")
+            logger.error("Skipping event %s - invalid amount: %s. Error: %s", event_id, raw_amount, e)
             return
-        self.state_store.update_daily_sum(customer_id, event)
+
+        # Marked only once the event is valid, so a rejected event can still be replayed after being fixed
+        state_store.mark_seen(event_id)
 
         # Set latest event time seen
-        if self.max_event_time is None:
+        if event_time > self.max_event_time:
             self.max_event_time = event_time
-        else:
-            self.max_event_time = max(self.max_event_time, event_time)
 
-        # Evict old events beyond 30 days from the latest event time seen
-        self._evict_old_events(customer_id, self.max_event_time)
+        return customer_id, event["_day"], amount
+
+    # Second half of process_event: adds an accepted event to the customer state and computes the features,
+    # evicting old events beyond 30 days from watermark (the latest event time seen when it was accepted)
+    def apply_event(self, customer_id: str, day: int, amount: float, watermark: int) -> Dict:
+        self.state_store.update_daily_sum(customer_id, day, amount)
+        self._evict_old_events(customer_id, watermark)
         return self._compute_features(customer_id)
 
 # This function simulates batching by 5-minute time windows (tumbling windows).
-def batch_by_time_window(kafka_stream, window_size=timedelta(minutes=5)):
-    batches = {}  # {window_key: {customer_id: [events]}}
-    
-    for event in kafka_stream:
-        event_time = datetime.fromisoformat(event["event_time"])
-        
-        # Include year/month/day/hour/minute to ensure events from different dates don't collide
-        window_key = (
-            event_time.year,
-            event_time.month,
-            event_time.day,
-            event_time.hour,
-            event_time.minute // 5 * 5
-        )
-        
-        if window_key not in batches:
-            batches[window_key] = {}
-        
-        customer_id = event["customer_id"]
-        if customer_id not in batches[window_key]:
-            batches[window_key][customer_id] = []
-        
-        batches[window_key][customer_id].append(event)
-    
-    return batches.values()
+# Consecutive events of the same window are grouped by customer and yielded as soon as the next window starts,
+# so only the current window is kept in memory. A late event reopens its window as a new, separate batch.
+def group_adjacent_by_window(kafka_stream, window_size=timedelta(minutes=5)) -> Generator[Tuple[int, Dict[str, List[Dict]]], None, None]:
+    window_seconds = int(window_size.total_seconds())
+
+    # Number of the window since the epoch, so events from different dates don't collide
+    def window_key(event: Dict) -> Optional[int]:
+        try:
+            return _parse_event(event) // window_seconds
+        except (KeyError, ValueError, TypeError, OverflowError):
+            return None  # missing or invalid event_time, skipped and logged by process_event
+
+    for window, events in groupby(kafka_stream, key=window_key):
+        customer_batches = {}  # {customer_id: [events]}
+        for event in events:
+            customer_id = event.get("customer_id")  # a missing customer_id is reported by process_event
+            if customer_id not in customer_batches:
+                customer_batches[customer_id] = []
+            customer_batches[customer_id].append(event)
+        yield window, customer_batches
+
+# Shard of a customer, crc32 is used instead of hash() because string hashes change between runs
+def _shard(customer_id, n_workers: int) -> int:
+    return zlib.crc32(str(customer_id).encode()) % n_workers
+
+# Worker process, it owns the state of the customers of its shard (like a consumer of a Kafka consumer group
+# assigned to a subset of the partitions). It receives events already accepted by the driver, each one with
+# the global watermark at that point of the stream, so the results don't depend on the number of workers.
+# On failure the exception is sent back instead of the state, so the driver can re-raise it.
+def _feature_worker(events_queue, results_queue):
+    try:
+        state_store = StateStore()
+        feature_builder = FeatureBuilder(state_store)
+
+        for accepted_events in iter(events_queue.get, None):  # None is sent when the stream ends
+            for customer_id, day, amount, watermark in accepted_events:
+                feature_builder.apply_event(customer_id, day, amount, watermark)
+
+        results_queue.put(state_store.balances)
+    except Exception as e:
+        e.add_note(f"Raised in feature worker {os.getpid()}:\n{traceback.format_exc()}")
+        results_queue.put(e)
+
+# Waits for the next worker result, re-raising worker errors and failing if the workers died without one
+def _get_worker_result(results_queue, workers):
+    while True:
+        try:
+            result = results_queue.get(timeout=1)
+            break
+        except queue.Empty:
+            if any(worker.is_alive() for worker in workers):
+                continue
+            # last look, a worker may have sent its result right before exiting
+            try:
+                result = results_queue.get(timeout=1)
+                break
+            except queue.Empty:
+                raise RuntimeError("Feature workers exited without sending their state") from None
+
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+# Processes the stream on n_workers processes partitioned by customer_id, then merges their state in state_store
+def process_partitioned(kafka_stream, state_store: StateStore, n_workers: int = N_WORKERS):
+    events_queues = [multiprocessing.Queue() for _ in range(n_workers)]
+    results_queue = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=_feature_worker, args=(events_queue, results_queue))
+        for events_queue in events_queues
+    ]
+    for worker in workers:
+        worker.start()
+
+    # The driver sees the whole stream in order: it deduplicates, validates and tracks the global watermark
+    # exactly like the serial FeatureBuilder does, the workers only update the state of their customers
+    ingress = FeatureBuilder(state_store)
+
+    try:
+        for _, customer_batches in group_adjacent_by_window(kafka_stream):
+            shard_batches = [[] for _ in range(n_workers)]
+            for customer_id, events in customer_batches.items():
+                shard_batch = shard_batches[_shard(customer_id, n_workers)]
+                for event in events:
+                    accepted = ingress.accept_event(event)
+                    if accepted is not None:
+                        shard_batch.append((*accepted, ingress.max_event_time))
+
+            for events_queue, events in zip(events_queues, shard_batches):
+                if events:
+                    events_queue.put(events)
+
+        for events_queue in events_queues:
+            events_queue.put(None)
+
+        # Results are collected before joining, a worker doesn't exit until its queued result is consumed
+        for _ in workers:
+            state_store.merge(_get_worker_result(results_queue, workers))
+    except BaseException:
+        # Stop the workers and don't wait at exit for events that nobody will read
+        for worker in workers:
+            worker.terminate()
+        for events_queue in events_queues:
+            events_queue.cancel_join_thread()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
 
 def main():
     state_store = StateStore()
-    feature_builder = FeatureBuilder(state_store)
-
-    for customer_batches in batch_by_time_window(simulated_kafka_stream(num_customers=100, events_per_customer=20)): ## Use seed to show replyability
-        for _, events in customer_batches.items():
-            for event in events:
-                #print("Processing event:", event["event_id"], "time:", 
-                #      datetime.fromisoformat(event["event_time"]), 
-                #      "amount:", event["amount"])
-                #print(f"Feature update for customer {event['customer_id']}: {feature_builder.process_event(event)}\n")
-                feature_builder.process_event(event)
-
-    state_store.save_on_file()
+
+    process_partitioned(simulated_kafka_stream(num_customers=100, events_per_customer=20), state_store) ## Use seed to show replyability
+
+    save_future = state_store.save_on_file_async()
     
     # Score a few random customers
-    for customer_id, customer_data in state_store.get_five_random_customers():
-        features = customer_data.get("features", {})
-        score = score_customer("artifacts/high_value_customer_model.json", features)
+    customers = state_store.get_five_random_customers()
+    features_list = [customer_data.features or {} for _, customer_data in customers]
+    scores = score_customers("artifacts/high_value_customer_model.json", features_list)
+    for (customer_id, _), features, score in zip(customers, features_list, scores):
         print(f"Customer {customer_id} score: {score:.4f} with features: {features}")
 
+    save_future.result()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
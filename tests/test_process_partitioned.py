@@ -0,0 +1,66 @@
+import logging
+import os
+import random
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from feature_builder import FeatureBuilder, StateStore, process_partitioned, simulated_kafka_stream
+
+
+def setUpModule():
+    logging.disable(logging.CRITICAL)  # skipped duplicates would otherwise end up in log/feature_builder.log
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+def shuffled_stream(seed):
+    events = list(simulated_kafka_stream(num_customers=30, events_per_customer=20, seed=seed))
+    random.Random(seed).shuffle(events)
+    return events
+
+def features_of(state_store):
+    return {customer_id: customer.features for customer_id, customer in state_store.balances.items()}
+
+def serial_state(events):
+    state_store = StateStore()
+    feature_builder = FeatureBuilder(state_store)
+    for event in events:
+        feature_builder.process_event(dict(event))
+    return state_store
+
+def partitioned_state(events, n_workers):
+    state_store = StateStore()
+    process_partitioned((dict(event) for event in events), state_store, n_workers)
+    return state_store
+
+
+class ProcessPartitionedTest(unittest.TestCase):
+
+    def test_same_features_as_serial_for_any_worker_count(self):
+        events = shuffled_stream(seed=7)
+        serial = serial_state(events)
+
+        for n_workers in (1, 2, 8):
+            with self.subTest(n_workers=n_workers):
+                partitioned = partitioned_state(events, n_workers)
+                self.assertEqual(features_of(partitioned), features_of(serial))
+                self.assertEqual(partitioned.seen_event_ids, serial.seen_event_ids)
+
+    def test_late_event_is_evicted_against_the_global_watermark(self):
+        # C005 is 50 days behind the latest event of the stream, which belongs to another customer
+        day = 86400
+        events = [
+            {"event_id": 1, "customer_id": "C000", "event_time": 100 * day, "event_type": "transaction", "amount": 5.0},
+            {"event_id": 2, "customer_id": "C005", "event_time": 50 * day, "event_type": "transaction", "amount": 7.0},
+        ]
+
+        for n_workers in (1, 2, 8):
+            with self.subTest(n_workers=n_workers):
+                partitioned = partitioned_state(events, n_workers)
+                self.assertEqual(partitioned.balances["C005"].features["total_txn_30d"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()